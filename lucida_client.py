@@ -2,13 +2,14 @@
 Lucida-Sync - Python Web Scraper
 Web scraping client for Lucida.to
 """
-from curl_cffi import requests
+from curl_cffi.requests import AsyncSession
 from bs4 import BeautifulSoup
 from playwright.async_api import async_playwright
 import asyncio 
 from typing import Optional, List, Dict, Any, Union
 import re
 import os
+import shutil
 import random
 from urllib.parse import urljoin, quote
 import time
@@ -18,6 +19,15 @@ from rich.console import Console
 
 console = Console()
 
+# Desktop Chrome fingerprint shared by every browser context we open
+BROWSER_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+BROWSER_VIEWPORT = {'width': 1920, 'height': 1080}
+
+
+def headless_enabled() -> bool:
+    """Chromium runs headless unless LUCIDA_HEADLESS=0"""
+    return os.getenv("LUCIDA_HEADLESS", "1") == "1"
+
 class RateLimiter:
     """
     Advanced rate limiter with sliding window and exponential backoff.
@@ -34,68 +44,79 @@ class RateLimiter:
         self.requests_per_hour = requests_per_hour
         self.min_delay = min_delay
 
-        # Track request timestamps
+        # Track request timestamps (oldest on the left)
         self.request_times = deque(maxlen=requests_per_hour)
-        self.last_request_time = 0
+        self.minute_times = deque(maxlen=requests_per_minute)
+        self.last_request_time = float("-inf")  # monotonic clock, no request yet
+        self.total_requests = 0
 
         # Exponential backoff for errors
         self.consecutive_errors = 0
         self.max_backoff = 300  # 5 minutes max
 
-    def wait(self):
-        """Wait if necessary to respect rate limits"""
-        current_time = time.time()
-
-        # Enforce minimum delay between requests
-        time_since_last = current_time - self.last_request_time
-        if time_since_last < self.min_delay:
-            sleep_time = self.min_delay - time_since_last
-            time.sleep(sleep_time)
-            current_time = time.time()
+        self._lock = asyncio.Lock()
 
-        # Check per-minute limit (sliding window)
+    def _evict_expired(self, current_time: float):
+        """Drop timestamps that have fallen out of the sliding windows"""
         one_minute_ago = current_time - 60
-        recent_requests = sum(1 for t in self.request_times if t > one_minute_ago)
-        if recent_requests >= self.requests_per_minute:
-            # Calculate wait time until oldest request expires
-            oldest_in_window = min(
-                (t for t in self.request_times if t > one_minute_ago),
-                default=one_minute_ago,
-            )
-            wait_time = 60 - (current_time - oldest_in_window) + 1
-            print(f"Rate limit: waiting {wait_time:.1f}s (per-minute limit)")
-            time.sleep(wait_time)
-            current_time = time.time()
-
-        # Check per-hour limit
+        while self.minute_times and self.minute_times[0] <= one_minute_ago:
+            self.minute_times.popleft()
+
         one_hour_ago = current_time - 3600
-        hour_requests = sum(1 for t in self.request_times if t > one_hour_ago)
-        if hour_requests >= self.requests_per_hour:
-            oldest_in_hour = min(
-                (t for t in self.request_times if t > one_hour_ago),
-                default=one_hour_ago,
-            )
-            wait_time = 3600 - (current_time - oldest_in_hour) + 1
-            print(f"Rate limit: waiting {wait_time / 60:.1f}m (per-hour limit)")
-            time.sleep(wait_time)
-            current_time = time.time()
-
-        # Exponential backoff for consecutive errors
-        if self.consecutive_errors > 0:
-            backoff = min(
-                self.min_delay * (2**self.consecutive_errors),
-                self.max_backoff,
-            )
-            print(
-                f"Exponential backoff: waiting {backoff:.1f}s "
-                f"(error #{self.consecutive_errors})"
-            )
-            time.sleep(backoff)
-            current_time = time.time()
-
-        # Record this request
-        self.request_times.append(current_time)
-        self.last_request_time = current_time
+        while self.request_times and self.request_times[0] <= one_hour_ago:
+            self.request_times.popleft()
+
+    async def wait(self):
+        """Wait if necessary to respect rate limits"""
+        # Serialize concurrent slots so the windows are checked one at a time
+        async with self._lock:
+            min_delay = self.min_delay
+            minute_times = self.minute_times
+            request_times = self.request_times
+            current_time = time.monotonic()
+
+            # Enforce minimum delay between requests
+            time_since_last = current_time - self.last_request_time
+            if time_since_last < min_delay:
+                sleep_time = min_delay - time_since_last
+                await asyncio.sleep(sleep_time)
+                current_time = time.monotonic()
+
+            # Check per-minute limit (sliding window)
+            self._evict_expired(current_time)
+            if len(minute_times) >= self.requests_per_minute:
+                # Calculate wait time until oldest request expires
+                wait_time = 60 - (current_time - minute_times[0]) + 1
+                console.log(f"[yellow]Rate limit:[/yellow] waiting {wait_time:.1f}s (per-minute limit)")
+                await asyncio.sleep(wait_time)
+                current_time = time.monotonic()
+                self._evict_expired(current_time)
+
+            # Check per-hour limit
+            if len(request_times) >= self.requests_per_hour:
+                wait_time = 3600 - (current_time - request_times[0]) + 1
+                console.log(f"[yellow]Rate limit:[/yellow] waiting {wait_time / 60:.1f}m (per-hour limit)")
+                await asyncio.sleep(wait_time)
+                current_time = time.monotonic()
+
+            # Exponential backoff for consecutive errors
+            if self.consecutive_errors > 0:
+                backoff = min(
+                    min_delay * (2**self.consecutive_errors),
+                    self.max_backoff,
+                )
+                console.log(
+                    f"[yellow]Exponential backoff:[/yellow] waiting {backoff:.1f}s "
+                    f"(error #{self.consecutive_errors})"
+                )
+                await asyncio.sleep(backoff)
+                current_time = time.monotonic()
+
+            # Record this request
+            request_times.append(current_time)
+            minute_times.append(current_time)
+            self.last_request_time = current_time
+            self.total_requests += 1
 
     def record_success(self):
         """Reset error counter on successful request"""
@@ -107,19 +128,13 @@ class RateLimiter:
 
     def get_stats(self) -> Dict[str, Any]:
         """Get current rate limiter statistics"""
-        current_time = time.time()
-        one_minute_ago = current_time - 60
-        one_hour_ago = current_time - 3600
+        self._evict_expired(time.monotonic())
 
         return {
-            "requests_last_minute": sum(
-                1 for t in self.request_times if t > one_minute_ago
-            ),
-            "requests_last_hour": sum(
-                1 for t in self.request_times if t > one_hour_ago
-            ),
+            "requests_last_minute": len(self.minute_times),
+            "requests_last_hour": len(self.request_times),
             "consecutive_errors": self.consecutive_errors,
-            "total_requests": len(self.request_times),
+            "total_requests": self.total_requests,
         }
 
 
@@ -135,11 +150,14 @@ class LucidaClient:
     ):
         self.base_url = base_url
         self.timeout = timeout
-        self.session = requests.Session(impersonate="chrome120")
-        self.session.headers.update(
-            {
+        # Shared async session: libcurl keeps connections alive between calls
+        self.http = AsyncSession(
+            impersonate="chrome120",
+            timeout=timeout,
+            max_clients=3,
+            headers={
                 "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            }
+            },
         )
 
         # Initialize advanced rate limiter
@@ -149,9 +167,106 @@ class LucidaClient:
             min_delay=2.0,  # Conservative 2 second minimum delay
         )
 
-    def _rate_limit(self):
+        # Directories already created by download_track
+        self._ensured_dirs = set()
+
+        # Download request recorded from a browser click, replayed over HTTP
+        # (None: not seen yet, False: replay doesn't work)
+        self._download_endpoint = None
+
+    def _ensure_dir(self, path: str):
+        """Create a directory once per client instead of on every download"""
+        if path not in self._ensured_dirs:
+            os.makedirs(path, exist_ok=True)
+            self._ensured_dirs.add(path)
+
+    async def _rate_limit(self):
         """Apply rate limiting before making requests"""
-        self.rate_limiter.wait()
+        await self.rate_limiter.wait()
+
+    async def fetch(self, url: str, **kwargs):
+        """GET a URL over the shared keep-alive session"""
+        await self._rate_limit()
+        return await self.http.get(url, **kwargs)
+
+    async def aclose(self):
+        """Close the shared HTTP session"""
+        await self.http.close()
+
+    def _record_download_request(self, request, track_url: str):
+        """Remember the POST a Download click sends, with the track URL templated out"""
+        if self._download_endpoint is not None or request.method != "POST":
+            return
+        if not request.url.startswith(self.base_url):
+            return
+        post_data = request.post_data or ""
+        for encoded in (track_url, quote(track_url, safe="")):
+            if encoded in post_data:
+                self._download_endpoint = {
+                    "url": request.url,
+                    "headers": {
+                        k: v
+                        for k, v in request.headers.items()
+                        if k.lower() not in ("cookie", "content-length", "host")
+                    },
+                    "data": post_data.replace(encoded, "{url}"),
+                    "quoted": encoded != track_url,
+                }
+                return
+
+    async def _download_direct(self, url: str, output_path: str, context) -> Optional[Dict[str, Any]]:
+        """
+        Replay the recorded download request with the browser's cookies.
+        Returns None when the endpoint fails, refuses, or answers with something
+        other than audio, so the caller can fall back to Playwright.
+        The caller has already taken the rate-limit slot for this track.
+        """
+        endpoint = self._download_endpoint
+        if not endpoint:
+            return None
+
+        track_url = quote(url, safe="") if endpoint["quoted"] else url
+        cookies = {c["name"]: c["value"] for c in await context.cookies(self.base_url)}
+
+        console.print(f"[cyan]Requesting download directly:[/cyan] {url}")
+        resp = await self.http.request(
+            "POST",
+            endpoint["url"],
+            data=endpoint["data"].replace("{url}", track_url),
+            headers=endpoint["headers"],
+            cookies=cookies,
+            stream=True,
+        )
+        try:
+            content_type = resp.headers.get("content-type", "")
+            if resp.status_code == 403:
+                console.print("[yellow]Direct download refused (CAPTCHA?), using browser...[/yellow]")
+                return None
+            if resp.status_code != 200:
+                # e.g. 429/5xx: let the browser handle this track, keep replaying later ones
+                return None
+            if not (content_type.startswith("audio/") or content_type == "application/octet-stream"):
+                # Not a file endpoint; stop recording and replaying for this client
+                self._download_endpoint = False
+                return None
+
+            final_path = os.path.abspath(output_path)
+            self._ensure_dir(os.path.dirname(final_path))
+            part_path = final_path + ".part"
+            try:
+                with open(part_path, "wb") as f:
+                    async for chunk in resp.aiter_content():
+                        f.write(chunk)
+                os.replace(part_path, final_path)
+            except BaseException:
+                # Don't leave a half-written file behind when falling back
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+        finally:
+            await resp.aclose()
+
+        return {"success": True, "filepath": final_path, "size": os.path.getsize(final_path)}
 
     def _launch_browser_context(self, p, user_data_dir: str):
         """Helper to launch a persistent browser context with stealth settings."""
@@ -168,10 +283,10 @@ class LucidaClient:
         
         context = p.chromium.launch_persistent_context(
             user_data_dir,
-            headless=False,
+            headless=headless_enabled(),
             args=args,
-            viewport={'width': 1920, 'height': 1080},
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+            viewport=BROWSER_VIEWPORT,
+            user_agent=BROWSER_USER_AGENT
         )
         
         # Additional stealth scripts
@@ -188,10 +303,13 @@ class LucidaClient:
         Asynchronous version of download_track.
         """
         download_dir = os.getenv("DOWNLOAD_DIR", r"C:\Musics\FLAC")
+
+        # One rate-limit slot per track, whether it goes direct or via the browser
+        await self._rate_limit()
         
         async def _perform_download_async(p_page):
             try:
-                os.makedirs(download_dir, exist_ok=True)
+                self._ensure_dir(download_dir)
                 
                 console.print(f"[cyan]Navigating to Lucida:[/cyan] {url}")
                 # Use 'commit' to get control the moment the server responds
@@ -201,19 +319,51 @@ class LucidaClient:
                 
                 # Wait for button
                 console.print(f"[dim]Waiting for download button...[/dim]")
+                # Race the button against the Cloudflare challenge (30 seconds max)
+                btn_task = asyncio.create_task(
+                    p_page.wait_for_selector(download_btn_selector, timeout=30000)
+                )
+                # Both CAPTCHA signals in one in-page check; the iframe only counts
+                # when visible (same rule as Playwright: non-empty box, not hidden)
+                captcha_task = asyncio.create_task(
+                    p_page.wait_for_function(
+                        '''() => {
+                            const cf = document.querySelector("iframe[src*='cloudflare']");
+                            if (cf) {
+                                const rect = cf.getBoundingClientRect();
+                                if (rect.width > 0 && rect.height > 0
+                                        && getComputedStyle(cf).visibility !== 'hidden') {
+                                    return true;
+                                }
+                            }
+                            return document.title.includes('Verify you are human');
+                        }''',
+                        timeout=30000,
+                    )
+                )
                 button_found = False
-                for i in range(150): # 30 seconds max
-                    if await p_page.locator(download_btn_selector).first.is_visible():
-                        button_found = True
-                        break
-                    
-                    if await p_page.locator("iframe[src*='cloudflare']").is_visible() or "Verify you are human" in await p_page.title():
-                        console.print("[bold red]CAPTCHA DETECTED: Solve it to continue...[/bold red]")
-                        await p_page.wait_for_selector(download_btn_selector, timeout=300000)
-                        button_found = True
-                        break
-                        
-                    await asyncio.sleep(0.1) # Faster polling (0.1s)
+                captcha_found = False
+                pending = {btn_task, captcha_task}
+                try:
+                    while pending and not (button_found or captcha_found):
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        button_found = btn_task in done and btn_task.exception() is None
+                        captcha_found = captcha_task in done and captcha_task.exception() is None
+                finally:
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(btn_task, captcha_task, return_exceptions=True)
+
+                if captcha_found and not button_found:
+                    if headless_enabled():
+                        # Nobody can see the challenge in a headless browser
+                        console.print(
+                            "[bold red]CAPTCHA DETECTED: re-run with LUCIDA_HEADLESS=0 to solve it.[/bold red]"
+                        )
+                        return {"success": False, "error": "CAPTCHA required; re-run with LUCIDA_HEADLESS=0"}
+                    console.print("[bold red]CAPTCHA DETECTED: Solve it to continue...[/bold red]")
+                    await p_page.wait_for_selector(download_btn_selector, timeout=300000)
+                    button_found = True
                 
                 if not button_found:
                     return {"success": False, "error": "Download button never appeared."}
@@ -226,34 +376,40 @@ class LucidaClient:
                 console.print(f"[bold yellow]Clicking download button...[/bold yellow]")
                 
                 download = None
-                async with p_page.expect_download(timeout=300000) as download_info:
-                    # Retry logic for the CLICK action
-                    # Lucida sometimes ignores the first click or gets stuck. 
-                    # We try clicking, wait to see if download starts, and retry if not.
-                    for attempt in range(5):
-                        try:
-                            # Ensure button is visible before clicking
-                            btn = p_page.locator(download_btn_selector).first
-                            if await btn.is_visible():
-                                await btn.click(force=True)
+                # Capture the request behind the click so later tracks can skip the browser
+                record_request = lambda request: self._record_download_request(request, url)
+                p_page.on("request", record_request)
+                try:
+                    async with p_page.expect_download(timeout=300000) as download_info:
+                        # Retry logic for the CLICK action
+                        # Lucida sometimes ignores the first click or gets stuck. 
+                        # We try clicking, wait to see if download starts, and retry if not.
+                        for attempt in range(5):
+                            try:
+                                # Ensure button is visible before clicking
+                                btn = p_page.locator(download_btn_selector).first
+                                if await btn.is_visible():
+                                    await btn.click(force=True)
                             
-                            # Wait up to 15s for the download to *start*
-                            # Use shield() to preserve the underlying download_info future if we timeout here
-                            download = await asyncio.wait_for(asyncio.shield(download_info.value), timeout=15.0)
+                                # Wait up to 15s for the download to *start*
+                                # Use shield() to preserve the underlying download_info future if we timeout here
+                                download = await asyncio.wait_for(asyncio.shield(download_info.value), timeout=15.0)
                             
-                            # If we get here, download started successfully
-                            break
-                        except asyncio.TimeoutError:
-                            if attempt < 4:
-                                console.print(f"[yellow]Download didn't start within 15s. Retrying click (Attempt {attempt+2}/5)...[/yellow]")
-                                await asyncio.sleep(1.0)
-                            else:
-                                console.print(f"[red]All click retries failed. Waiting for remaining timeout...[/red]")
+                                # If we get here, download started successfully
+                                break
+                            except asyncio.TimeoutError:
+                                if attempt < 4:
+                                    console.print(f"[yellow]Download didn't start within 15s. Retrying click (Attempt {attempt+2}/5)...[/yellow]")
+                                    await asyncio.sleep(1.0)
+                                else:
+                                    console.print(f"[red]All click retries failed. Waiting for remaining timeout...[/red]")
                     
-                    # If we fell through the loop without success, wait for the original future 
-                    # (in case it's just very slow but eventually works)
-                    if not download:
-                        download = await download_info.value
+                        # If we fell through the loop without success, wait for the original future 
+                        # (in case it's just very slow but eventually works)
+                        if not download:
+                            download = await download_info.value
+                finally:
+                    p_page.remove_listener("request", record_request)
                 console.print(f"[green]Download starting:[/green] {download.suggested_filename}")
                 
                 if output_path:
@@ -261,8 +417,14 @@ class LucidaClient:
                 else:
                     final_path = os.path.abspath(os.path.join(download_dir, download.suggested_filename))
                 
-                os.makedirs(os.path.dirname(final_path), exist_ok=True)
-                await download.save_as(final_path)
+                self._ensure_dir(os.path.dirname(final_path))
+                # Move Playwright's temp file into place instead of copying it
+                tmp_path = await download.path()
+                try:
+                    os.replace(tmp_path, final_path)
+                except OSError:
+                    # Different drive/filesystem
+                    shutil.move(tmp_path, final_path)
                 
                 if os.path.exists(final_path):
                     size = os.path.getsize(final_path)
@@ -274,10 +436,17 @@ class LucidaClient:
                 return {"success": False, "error": str(e)}
 
         if page:
+            if output_path:
+                try:
+                    result = await self._download_direct(url, output_path, page.context)
+                    if result:
+                        return result
+                except Exception as e:
+                    console.print(f"[dim red]Direct download failed, using browser: {e}[/dim red]")
             return await _perform_download_async(page)
         else:
             async with async_playwright() as p:
-                browser = await p.chromium.launch(headless=True)
+                browser = await p.chromium.launch(headless=headless_enabled())
                 new_page = await browser.new_page()
                 result = await _perform_download_async(new_page)
                 await browser.close()
@@ -3,20 +3,43 @@ import time
 import random
 import re
 import asyncio
-from lucida_client import LucidaClient
+import hashlib
+from lucida_client import LucidaClient, BROWSER_USER_AGENT, BROWSER_VIEWPORT, headless_enabled
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from diskcache import Cache
 from dotenv import load_dotenv, set_key
 from rich.console import Console
 from rich.prompt import Prompt
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+
+try:
+    import uvloop
+except ImportError:  # uvloop is Linux/macOS only
+    uvloop = None
 
 console = Console()
 
+# Amazon Music (and its CDN) assets the search scrape never needs
+AMAZON_URL_PATTERN = re.compile(r"^https?://[^/]*amazon\.com/")
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+AMAZON_LINK_CACHE_TTL = 30 * 24 * 3600  # 30 days
+
+# Pipeline sizing: Amazon search workers feed Lucida download workers
+SEARCH_WORKERS = 2
+DOWNLOAD_WORKERS = 3
+PIPELINE_QUEUE_SIZE = 6
+
+# Characters not allowed in Windows filenames
+FILENAME_TRANSLATE_TABLE = str.maketrans('', '', '<>:"/\\|?*')
+
 class SpotifyToFlac:
     def __init__(self):
         self.client = LucidaClient()
+        self.cache = Cache(os.path.abspath("./.lucida_cache"))
         self.setup_credentials()
+        os.makedirs(self.download_dir, exist_ok=True)
         
     def setup_credentials(self):
         """Load credentials from .env or ask user."""
@@ -65,11 +88,32 @@ class SpotifyToFlac:
 
     def _sanitize_filename(self, name):
         """Clean string for use as a filename."""
-        return re.sub(r'[<>:"/\\|?*]', '', name).strip()
+        return name.translate(FILENAME_TRANSLATE_TABLE).strip()
+
+    async def _block_amazon_assets(self, route):
+        """Abort images/fonts/media on Amazon pages; Lucida assets are untouched."""
+        if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    def _amazon_cache_key(self, query):
+        """Cache key for the Amazon link resolved from a search query."""
+        return ("amazon", hashlib.sha1(query.encode("utf-8")).hexdigest())
+
+    def _invalidate_amazon_link(self, query):
+        """Forget a cached Amazon link so the next sync searches again."""
+        self.cache.delete(self._amazon_cache_key(query))
 
     async def get_direct_amazon_link_async(self, query, page):
         from urllib.parse import quote
         
+        cache_key = self._amazon_cache_key(query)
+        cached_url = self.cache.get(cache_key)
+        if cached_url is not None:
+            console.print(f"[dim]Cached Amazon link for:[/dim] {query}")
+            return cached_url
+
         search_url = f"https://music.amazon.com/search/{quote(query)}"
         console.print(f"[cyan]Searching Amazon Music:[/cyan] {query}")
         
@@ -80,23 +124,30 @@ class SpotifyToFlac:
             try:
                 # Pierce shadow DOM to find results
                 # Amazon Music now uses custom elements like music-horizontal-item
-                await page.wait_for_selector('music-horizontal-item, music-vertical-item, a[href*="trackAsin"]', timeout=15000)
-            except:
+                # "attached" resolves as soon as a result is in the DOM, without waiting for layout/paint
+                await page.locator(
+                    'a[href*="trackAsin="], a[href*="/tracks/"], '
+                    'music-horizontal-item[primary-href], music-vertical-item[primary-href]'
+                ).first.wait_for(state="attached", timeout=8000)
+            except PlaywrightTimeoutError:
                 pass
 
-            # Extract links from standard anchors and custom elements
+            # Let the DOM pick the first matching link so only one string crosses IPC
             # music-horizontal-item and music-vertical-item store the link in 'primary-href' attribute
-            hrefs = await page.evaluate('''() => {
-                const anchors = Array.from(document.querySelectorAll('a')).map(a => a.href);
-                const items = Array.from(document.querySelectorAll('music-horizontal-item, music-vertical-item'));
-                const itemLinks = items.map(i => i.getAttribute('primary-href')).filter(h => h).map(h => h.startsWith('/') ? 'https://music.amazon.com' + h : h);
-                return [...anchors, ...itemLinks];
+            href = await page.evaluate('''() => {
+                for (const needle of ['trackAsin=', '/tracks/']) {
+                    const a = document.querySelector(`a[href*="${needle}"]`);
+                    if (a) return a.href;
+                    const item = document.querySelector(
+                        `music-horizontal-item[primary-href*="${needle}"], music-vertical-item[primary-href*="${needle}"]`
+                    );
+                    if (item) return new URL(item.getAttribute('primary-href'), 'https://music.amazon.com').href;
+                }
+                return null;
             }''')
-            
-            for href in hrefs:
-                if 'trackAsin=' in href: return href
-            for href in hrefs:
-                if '/tracks/' in href: return href
+            if href:
+                self.cache.set(cache_key, href, expire=AMAZON_LINK_CACHE_TTL)
+                return href
 
             # DEBUG: Take screenshot if no link found
             try:
@@ -107,7 +158,7 @@ class SpotifyToFlac:
                 console.print(f"[bold red]DEBUG: Saved screenshot and HTML for empty search: debug_empty_{debug_filename}[/bold red]")
                 
                 # DEBUG: Print all links found
-                all_links = hrefs # Use the same list we just extracted
+                all_links = await page.locator("a").evaluate_all("els => els.map(e => e.href)")
                 console.print(f"[dim]Found {len(all_links)} links on page. Sample: {all_links[:5]}[/dim]")
             except Exception as debug_e:
                  console.print(f"Failed to save debug info: {debug_e}")
@@ -138,83 +189,162 @@ class SpotifyToFlac:
             playlist_id = playlist_url.split("/")[-1].split("?")[0]
             console.print(f"Fetching tracks from Spotify Playlist ID: [green]{playlist_id}[/green]...")
             
-            results = self.sp.playlist_items(playlist_id)
+            # snapshot_id changes whenever the playlist is edited
+            snapshot_id = self.sp.playlist(playlist_id, fields="snapshot_id")['snapshot_id']
+            cache_key = ("playlist", playlist_id, snapshot_id)
+            tracks = self.cache.get(cache_key)
+            if tracks is not None:
+                console.print(f"[dim]Using cached track list ({len(tracks)} tracks)[/dim]")
+                return tracks
+
+            # Only request the fields we use, 100 items per page
+            results = self.sp.playlist_items(
+                playlist_id,
+                fields="items(track(name,artists(name))),next",
+                limit=100,
+                additional_types=("track",),
+            )
             tracks = []
             
-            for item in results['items']:
-                track = item['track']
-                if track:
-                    tracks.append({
-                        "query": f"{track['artists'][0]['name']} {track['name']}",
-                        "name": track['name'],
-                        "artist": track['artists'][0]['name']
-                    })
+            while True:
+                for item in results['items']:
+                    track = item['track']
+                    if track:
+                        tracks.append({
+                            "query": f"{track['artists'][0]['name']} {track['name']}",
+                            "name": track['name'],
+                            "artist": track['artists'][0]['name']
+                        })
+                if not results['next']:
+                    break
+                results = self.sp.next(results)
+
+            self.cache.set(cache_key, tracks)
             return tracks
         except Exception as e:
             console.print(f"[bold red]Error accessing Spotify playlist:[/bold red] {e}")
             return []
 
-    async def process_track_async(self, context, track_info, semaphore, index):
-        """Async worker: Search Amazon -> Download Lucida."""
-        # HIGHER STAGGERED START (5s per slot) to reduce initial burst load
-        await asyncio.sleep(index * 5) 
+    async def _new_worker_page(self, browser, storage_state_path=None):
+        """Create an isolated, pre-initialized context + page for one worker.
+
+        Search pages block Amazon assets; download pages carry the saved
+        Lucida session so Amazon cookies never mix with it.
+        """
+        if storage_state_path:
+            context = await browser.new_context(
+                accept_downloads=True,
+                storage_state=storage_state_path if os.path.exists(storage_state_path) else None,
+                user_agent=BROWSER_USER_AGENT,
+                viewport=BROWSER_VIEWPORT,
+            )
+        else:
+            context = await browser.new_context(
+                user_agent=BROWSER_USER_AGENT,
+                viewport=BROWSER_VIEWPORT,
+            )
+            await context.route(AMAZON_URL_PATTERN, self._block_amazon_assets)
+        page = await context.new_page()
+        page.set_default_timeout(60000)
+        await page.add_init_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+        return page
 
-        async with semaphore:
-            page = None
-            slot_id = f"[bold magenta]Slot {index+1}[/bold magenta]"
+    async def _reset_worker_page(self, page, browser, storage_state_path=None):
+        """Return a clean page for the next track (replace it if it died)."""
+        try:
+            await page.goto("about:blank")
+            return page
+        except Exception:
             try:
-                page = await context.new_page()
-                page.set_default_timeout(60000)
-                await page.add_init_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-                
-                console.print(f"\n{slot_id} [cyan]Processing:[/cyan] {track_info['name']}")
-                
-                # RETRY LOOP FOR SEARCH
-                amazon_url = None
-                for attempt in range(3):
-                    if attempt > 0:
-                        console.print(f"{slot_id} [yellow]Retrying Search (Attempt {attempt+1})...[/yellow]")
-                    
-                    amazon_url = await self.get_direct_amazon_link_async(track_info['query'], page)
-                    if amazon_url:
-                        break
-                    await asyncio.sleep(2)
-
-                if not amazon_url:
-                    console.print(f"{slot_id} [red]Skipping {track_info['name']}: Link not found after 3 tries.[/red]")
-                    return
-                
-                # RETRY LOOP FOR DOWNLOAD
-                safe_name = self._sanitize_filename(f"{track_info['artist']} - {track_info['name']}.flac")
-                output_path = os.path.join(self.download_dir, safe_name)
-                
-                success = False
-                for attempt in range(2):
-                    if attempt > 0:
-                        console.print(f"{slot_id} [yellow]Retrying Download (Attempt {attempt+1})...[/yellow]")
-                    
-                    result = await self.client.download_track(amazon_url, output_path=output_path, page=page)
-                    if result.get("success"):
-                        console.print(f"{slot_id} [bold green]✓ COMPLETED:[/bold green] {safe_name}")
-                        success = True
-                        break
-                    else:
-                        console.print(f"{slot_id} [dim red]Attempt {attempt+1} failed: {result.get('error')}[/dim red]")
-                        # navigate back or refresh if stuck
-                        await page.goto("about:blank")
+                await page.context.close()
+            except Exception:
+                pass
+            return await self._new_worker_page(browser, storage_state_path)
+
+    async def search_worker_async(self, browser, search_q, download_q):
+        """Pipeline stage 1: Search Amazon -> queue the link for download."""
+        page = await self._new_worker_page(browser)
+        try:
+            while True:
+                item = await search_q.get()
+                if item is None:
+                    break
+                index, track_info = item
+                slot_id = f"[bold magenta]Slot {index+1}[/bold magenta]"
+                try:
+                    console.print(f"\n{slot_id} [cyan]Processing:[/cyan] {track_info['name']}")
+
+                    # RETRY LOOP FOR SEARCH
+                    amazon_url = None
+                    for attempt in range(3):
+                        if attempt > 0:
+                            console.print(f"{slot_id} [yellow]Retrying Search (Attempt {attempt+1})...[/yellow]")
+
+                        amazon_url = await self.get_direct_amazon_link_async(track_info['query'], page)
+                        if amazon_url:
+                            break
                         await asyncio.sleep(2)
 
-                if not success:
-                    console.print(f"{slot_id} [bold red]✗ PERMANENT FAILURE:[/bold red] {safe_name}")
+                    if not amazon_url:
+                        console.print(f"{slot_id} [red]Skipping {track_info['name']}: Link not found after 3 tries.[/red]")
+                        continue
+
+                    await download_q.put((index, track_info, amazon_url))
+
+                except Exception as e:
+                    console.print(f"{slot_id} [bold red]Search Error ({track_info['name']}):[/bold red] {e}")
+                finally:
+                    page = await self._reset_worker_page(page, browser)
+        finally:
+            await page.context.close()
+
+    async def download_worker_async(self, browser, download_q, worker_index, storage_state_path):
+        """Pipeline stage 2: Download queued links from Lucida."""
+        # STAGGERED START (5s per worker) to reduce initial burst load
+        await asyncio.sleep(worker_index * 5)
+
+        page = await self._new_worker_page(browser, storage_state_path)
+        try:
+            while True:
+                item = await download_q.get()
+                if item is None:
+                    break
+                index, track_info, amazon_url = item
+                slot_id = f"[bold magenta]Slot {index+1}[/bold magenta]"
+                try:
+                    # RETRY LOOP FOR DOWNLOAD
+                    safe_name = self._sanitize_filename(f"{track_info['artist']} - {track_info['name']}.flac")
+                    output_path = os.path.join(self.download_dir, safe_name)
 
-            except Exception as e:
-                console.print(f"{slot_id} [bold red]Worker Error ({track_info['name']}):[/bold red] {e}")
-            finally:
-                if page:
-                    try:
-                        await page.close()
-                    except:
-                        pass
+                    success = False
+                    for attempt in range(2):
+                        if attempt > 0:
+                            console.print(f"{slot_id} [yellow]Retrying Download (Attempt {attempt+1})...[/yellow]")
+
+                        result = await self.client.download_track(amazon_url, output_path=output_path, page=page)
+                        if result.get("success"):
+                            console.print(f"{slot_id} [bold green]✓ COMPLETED:[/bold green] {safe_name}")
+                            success = True
+                            # Persist cookies (e.g. a solved CAPTCHA) for the next contexts
+                            await page.context.storage_state(path=storage_state_path)
+                            break
+                        else:
+                            console.print(f"{slot_id} [dim red]Attempt {attempt+1} failed: {result.get('error')}[/dim red]")
+                            # navigate back or refresh if stuck
+                            await page.goto("about:blank")
+                            await asyncio.sleep(2)
+
+                    if not success:
+                        console.print(f"{slot_id} [bold red]✗ PERMANENT FAILURE:[/bold red] {safe_name}")
+                        # The cached link may be the culprit (e.g. a mismatched track)
+                        self._invalidate_amazon_link(track_info['query'])
+
+                except Exception as e:
+                    console.print(f"{slot_id} [bold red]Worker Error ({track_info['name']}):[/bold red] {e}")
+                finally:
+                    page = await self._reset_worker_page(page, browser, storage_state_path)
+        finally:
+            await page.context.close()
 
     async def sync_playlist_async(self):
         while True:
@@ -230,39 +360,78 @@ class SpotifyToFlac:
                 continue
                 
             user_data_dir = os.path.abspath("./lucida_session")
+            os.makedirs(user_data_dir, exist_ok=True)
+            # Cookies/session shared between runs and slots
+            storage_state_path = os.path.join(user_data_dir, "storage_state.json")
 
             async with async_playwright() as p:
-                # Persistent context to keep cookies/session
-                context = await p.chromium.launch_persistent_context(
-                    user_data_dir,
-                    headless=False,
-                    accept_downloads=True,
-                    args=["--disable-blink-features=AutomationControlled"]
+                # One browser, one isolated context per worker
+                # Headless by default; set LUCIDA_HEADLESS=0 to watch or solve a CAPTCHA
+                browser = await p.chromium.launch(
+                    headless=headless_enabled(),
+                    args=[
+                        "--disable-blink-features=AutomationControlled",
+                        "--disable-features=TranslateUI,MediaRouter",
+                        "--disable-gpu",
+                        # One renderer per worker context
+                        f"--renderer-process-limit={SEARCH_WORKERS + DOWNLOAD_WORKERS}",
+                    ]
                 )
                 
-                console.print(f"[bold yellow]Syncing {len(tracks)} tracks (3 concurrent slots)...[/bold yellow]")
-                
-                # Create semaphore INSIDE the async loop
-                semaphore = asyncio.Semaphore(3)
-                
-                # Launch tasks with staggered start
-                tasks = []
-                for i, track in enumerate(tracks):
-                    tasks.append(self.process_track_async(context, track, semaphore, i))
-                
-                await asyncio.gather(*tasks)
+                console.print(
+                    f"[bold yellow]Syncing {len(tracks)} tracks "
+                    f"({SEARCH_WORKERS} search + {DOWNLOAD_WORKERS} download slots)...[/bold yellow]"
+                )
+
+                # Two-stage pipeline: searches run while earlier tracks download
+                search_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+                download_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+                searchers = [
+                    asyncio.create_task(self.search_worker_async(browser, search_q, download_q))
+                    for _ in range(SEARCH_WORKERS)
+                ]
+                downloaders = [
+                    asyncio.create_task(self.download_worker_async(browser, download_q, i, storage_state_path))
+                    for i in range(DOWNLOAD_WORKERS)
+                ]
 
-                await context.close()
-                console.print("[bold green]Playlist sync complete![/bold green]")
+                async def feed_tracks():
+                    for item in enumerate(tracks):
+                        await search_q.put(item)
+                    # None sentinels stop each stage once the previous one drains
+                    for _ in searchers:
+                        await search_q.put(None)
+                    await asyncio.gather(*searchers)
+                    for _ in downloaders:
+                        await download_q.put(None)
+
+                pipeline = [asyncio.create_task(feed_tracks()), *searchers, *downloaders]
+                try:
+                    await asyncio.gather(*pipeline)
+                    console.print("[bold green]Playlist sync complete![/bold green]")
+                except Exception as e:
+                    # e.g. a worker could not (re)create its browser context
+                    console.print(f"[bold red]Playlist sync aborted:[/bold red] {e}")
+                finally:
+                    for task in pipeline:
+                        task.cancel()
+                    await asyncio.gather(*pipeline, return_exceptions=True)
+                    await browser.close()
 
 async def main():
     try:
         syncer = SpotifyToFlac()
-        await syncer.sync_playlist_async()
+        try:
+            await syncer.sync_playlist_async()
+        finally:
+            await syncer.client.aclose()
     except KeyboardInterrupt:
         console.print("\n[bold red]Operation cancelled by user.[/bold red]")
     except Exception as e:
         console.print(f"\n[bold red]An unexpected error occurred: {e}[/bold red]")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())